@@ -0,0 +1,65 @@
+import importlib.util
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+# The post-processor is a script, load it as a module
+path = os.path.join(os.path.dirname(__file__), os.pardir, "umc-750-processor.py")
+spec = importlib.util.spec_from_file_location("umc_750_processor", path)
+processor = importlib.util.module_from_spec(spec)
+sys.modules["umc_750_processor"] = processor
+spec.loader.exec_module(processor)
+
+
+def operations(*tools):
+    return {n: SimpleNamespace(tool_path=tool_path, tool_number=tool_number)
+            for n, (tool_path, tool_number) in enumerate(tools, 1)}
+
+
+def tool_loads(operations, order):
+    loads = 0
+    current_tool = None
+
+    for operation in order:
+        if operations[operation].tool_number != current_tool:
+            loads += 1
+            current_tool = operations[operation].tool_number
+
+    return loads
+
+
+def test_groups_operations_by_tool():
+    ops = operations(("A_1", 1), ("B_1", 2), ("A_2", 1), ("B_2", 2))
+
+    assert processor.reorder_operations(ops, []) == [1, 3, 2, 4]
+
+
+def test_loads_a_tool_that_finishes_its_operations():
+    ops = operations(("A_1", 1), ("B_1", 2), ("A_2", 1))
+    order = processor.reorder_operations(ops, [("B_1", "A_2")])
+
+    assert order == [2, 1, 3]
+    assert tool_loads(ops, order) == 2
+
+
+def test_roughing_before_finishing():
+    ops = operations(("ROUGH_1", 1), ("ROUGH_2", 2), ("FINISH_1", 1), ("ROUGH_3", 2))
+    order = processor.reorder_operations(ops, [("ROUGH*", "FINISH*")])
+
+    assert order == [2, 4, 1, 3]
+    assert tool_loads(ops, order) == 2
+
+
+def test_keeps_order_without_gain():
+    ops = operations(("A_1", 1), ("B_1", 2), ("C_1", 3))
+
+    assert processor.reorder_operations(ops, []) == [1, 2, 3]
+
+
+def test_contradicting_constraints():
+    ops = operations(("A_1", 1), ("B_1", 2))
+
+    with pytest.raises(ValueError):
+        processor.reorder_operations(ops, [("A*", "B*"), ("B*", "A*")])
@@ -5,14 +5,84 @@
 # Note: Units are in inches
 
 import getopt, sys
+import bisect
+import configparser
+import fnmatch
+import hashlib
 import itertools
+import linecache
+import locale
 import math
+import multiprocessing
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 
 # If you don't wish to use the command, call your CLSF file 'cls.txt', place it in the same folder
 # as this python script, assing the debug variable to be true then run the script.
 debug = True
 
+# This is our machine profile class. It holds everything the post needs to know about a machine
+# that is not in the CLSF file. The class attributes are the defaults for the HAAS UMC750.
+class Machine:
+    
+    # List of Class Attributes
+    name = "UMC-750"
+    output = None # G-Code output file for this machine
+    B_limit = True
+    min_B_rotation = -35 # degrees
+    max_B_rotation = 120 # degrees
+    safe_start = "G40 G17 G94 G98 G90 G00 G49 G20"
+    work_offset = "G54"
+    tool_length_compensation = False # Output the compensation of the tool (E.g. G43 H1) after a tool change
+    
+    def __init__(self, name=None):
+        if name:
+            self.name = name
+        
+        # Hardcoding these values because not available in CLSF File
+        # Key is the tool name, value the spindle speed / tool length compensation
+        self.speeds = {"MILL": 1500, "BALL_MILL": 1500, "MILL_MULTI_AXIS": 1500}
+        self.tool_compensation = {"MILL": "G43", "BALL_MILL": "G234", "MILL_MULTI_AXIS": "G234"}
+    
+    # Parameters:
+    # profile (configparser.SectionProxy) : Section of the machine config file
+    def load_profile(self, profile):
+        self.output = profile.get('output', self.output)
+        self.B_limit = profile.getboolean('B_limit', self.B_limit)
+        self.min_B_rotation = profile.getfloat('min_B_rotation', self.min_B_rotation)
+        self.max_B_rotation = profile.getfloat('max_B_rotation', self.max_B_rotation)
+        self.safe_start = profile.get('safe_start', self.safe_start)
+        self.work_offset = profile.get('work_offset', self.work_offset)
+        self.tool_length_compensation = profile.getboolean('tool_length_compensation', self.tool_length_compensation)
+        
+        # Per tool values are given as "speed.<TOOL NAME>" and "compensation.<TOOL NAME>"
+        for key in profile:
+            if key.startswith('speed.'):
+                self.speeds[key[len('speed.'):]] = profile.getint(key)
+            elif key.startswith('compensation.'):
+                self.tool_compensation[key[len('compensation.'):]] = profile[key]
+    
+    # Parameters:
+    # config_path (String) : Path of the machine config file, one section per machine
+    # Returns a list of machines in the order of the config file
+    @staticmethod
+    def load_machines(config_path):
+        config = configparser.ConfigParser()
+        config.optionxform = str # Keep the case of the tool names
+        
+        with open(config_path) as config_file:
+            config.read_file(config_file)
+        
+        machines = []
+        for section in config.sections():
+            machine = Machine(section)
+            machine.load_profile(config[section])
+            machines.append(machine)
+            
+        return machines
+        
 # This is our tool class. It is a simple data structure.
 class Tool:
     
@@ -32,16 +102,15 @@ class Tool:
     tip_angle = None
     line_skip = None
     tool_number = None 
-    speed = None
     offset = 0 
     line_start = None
-    tool_compensation_type = None 
+    operation_number = None # Order of the operation in the CLSF file
     
     
-    def __init__(self, line):
+    def __init__(self, CLSF, line):
         current_line = line
         end_line = current_line + 2
-        lines = CLSF_to_GCode.CLSF[current_line:end_line]
+        lines = CLSF[current_line:end_line]
         
         # Check if tool is described in one or two lines in CLSF
         one_line = True
@@ -90,46 +159,431 @@ class Tool:
             
         # self.tool_number = Tool.tool_count
         # Tool.tool_count = Tool.tool_count + 1
+        # Spindle speed comes from the machine profile (See Machine)
+
+# This is our parsed CLSF file. It only holds what does not depend on the machine, so one
+# parse can be shared by the translators of every machine profile.
+class CLSF_Data:
+    
+    # Motion records (GOTO and CIRCLE lines) parsed ahead, None if not parsed ahead
+    # (record lines, record offsets, record values, rapid, feed, after circle) as merged arrays,
+    # turned into the lists below the first time a record is read (See load_records)
+    record_arrays = None
+    
+    # The values of record r are record_values[record_offsets[r]:record_offsets[r + 1]]
+    record_lines = None # Line number of every record
+    record_offsets = None
+    record_values = None
+    record_rapid = None # RAPID on the previous line
+    record_feed = None # FEDRAT on the previous line, NaN if none
+    record_after_circle = None # CIRCLE two lines before
+    record_cursor = 0 # Row after the last record read
+    tool_lines = None # Line number of every TOOL PATH line
+    
+    # Parameters:
+    # CLSF_path (String) : Path of the CLSF File
+    # workers (Int) : Number of processes parsing chunks of the file, one process if not given
+    def __init__(self, CLSF_path, workers=None):
         
-        # Hardcoding these values because not available in CLSF File
-        if self.tool_name == "MILL":
-            self.speed = 1500
-            self.tool_compensation_type = "G43"
-        elif self.tool_name == "BALL_MILL":
-            self.speed = 1500
-            self.tool_compensation_type = "G234"
-        elif self.tool_name == "MILL_MULTI_AXIS":
-            self.speed = 1500
-            self.tool_compensation_type = "G234"
+        if workers and workers > 1:
+            self.parse_parallel(CLSF_path, workers)
+            
+        else:
+            # Open and turn CLSF file into list of strings (by line)
+            with open(CLSF_path) as CLSF_File:
+                unstripped_CLSF = CLSF_File.readlines()
+                self.CLSF = [line.strip() for line in unstripped_CLSF]
+            
+            # Line number in the file of every line left, to report lines as they are in the file
+            self.line_numbers = [number for number, line in enumerate(self.CLSF, 1) if not 'PAINT' in line]
+            self.CLSF = [line for line in self.CLSF if not 'PAINT' in line]
+            self.CLSF = [line.split('$')[0] for line in self.CLSF]
+        
+        self.tools = {}
+        
+        # Key is operation number, value the tool
+        self.operations = {}
+        self.total_operations = 0
+        
+        self.index_operations()
+    
+    # Parallel Parsing ---------------------------------------------------------------------------
+    
+    # Split the file in byte ranges that start and end on line boundaries
+    # Returns a list of (start, end) byte positions
+    @staticmethod
+    def byte_ranges(CLSF_path, count):
+        size = os.path.getsize(CLSF_path)
+        boundaries = [0]
+        
+        with open(CLSF_path, 'rb') as CLSF_File:
+            for n in range(1, count):
+                CLSF_File.seek(n * size // count)
+                CLSF_File.readline()
+                position = CLSF_File.tell()
+                
+                if boundaries[-1] < position < size:
+                    boundaries.append(position)
+                    
+        boundaries.append(size)
+        
+        return list(zip(boundaries[:-1], boundaries[1:]))
+    
+    # Returns the context of a motion record: (rapid, feed, after_circle)
+    # Parameters:
+    # previous_line (String) : Line before the record
+    # line_before (String) : Line two lines before the record
+    @staticmethod
+    def line_context(previous_line, line_before):
+        rapid = 'RAPID' in previous_line
+        feed = None
+        
+        if 'FEDRAT' in previous_line:
+            feed = float(previous_line.split(',')[1])
+            
+        return rapid, feed, 'CIRCLE' in line_before
+    
+    # Parses the lines in a byte range of the file, this runs in a worker process
+    # Returns (lines, record lines, record value counts, record values, rapid, feed, after circle,
+    # circle, PAINT lines, TOOL PATH lines, number of lines in the chunk). Only the lines that are
+    # not parsed records are sent back, their text isn't needed with their values. The context of
+    # the records on the first two lines is resolved when the chunks are merged.
+    @staticmethod
+    def parse_chunk(CLSF_path, start, end):
+        with open(CLSF_path, 'rb') as CLSF_File:
+            CLSF_File.seek(start)
+            text = CLSF_File.read(end - start).decode(locale.getpreferredencoding(False))
+            
+        lines = [line.strip() for line in text.splitlines()]
+        chunk_line_count = len(lines)
+        paint_lines = [number for number, line in enumerate(lines) if 'PAINT' in line]
+        lines = [line for line in lines if not 'PAINT' in line]
+        lines = [line.split('$')[0] for line in lines]
+        
+        other_lines = []
+        tool_lines = []
+        record_lines = []
+        record_counts = []
+        record_values = []
+        record_rapid = []
+        record_feed = []
+        record_after_circle = []
+        record_circle = []
+        
+        line_count = 0
+        
+        for line in lines:
+            values = None
+            
+            if 'GOTO' in line or 'CIRCLE' in line:
+                try:
+                    values = [float(i) for i in line.split('/')[1].split(',')]
+                except (IndexError, ValueError):
+                    # Left to the translator, which reports the line
+                    values = None
+                    
+            if values is None:
+                other_lines.append(line)
+                
+                if 'TOOL PATH' in line:
+                    tool_lines.append(line_count)
+                    
+            else:
+                rapid, feed, after_circle = False, None, False
+                
+                if line_count >= 2:
+                    rapid, feed, after_circle = CLSF_Data.line_context(lines[line_count - 1], lines[line_count - 2])
+                
+                record_lines.append(line_count)
+                record_counts.append(len(values))
+                record_values.extend(values)
+                record_rapid.append(rapid)
+                record_feed.append(math.nan if feed is None else feed)
+                record_after_circle.append(after_circle)
+                record_circle.append('GOTO' not in line)
+                
+            line_count += 1
+        
+        return (other_lines, np.array(record_lines, dtype=np.int64), np.array(record_counts, dtype=np.int32),
+                np.array(record_values, dtype=np.float64), np.array(record_rapid, dtype=bool),
+                np.array(record_feed, dtype=np.float64), np.array(record_after_circle, dtype=bool),
+                np.array(record_circle, dtype=bool), np.array(paint_lines, dtype=np.int64),
+                np.array(tool_lines, dtype=np.int64), chunk_line_count)
+    
+    # Parse the file in chunks in worker processes, then merge the chunks in order
+    # The merge runs in this process, so it only puts arrays together and leaves turning the
+    # records into lists to the translator (See load_records)
+    def parse_parallel(self, CLSF_path, workers):
+        ranges = CLSF_Data.byte_ranges(CLSF_path, workers * 4)
+        
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(CLSF_Data.parse_chunk, itertools.repeat(CLSF_path),
+                                       [start for start, end in ranges], [end for start, end in ranges]))
+        
+        other_lines = []
+        chunk_starts = []
+        record_lines = []
+        line_numbers = []
+        tool_lines = []
+        line_count = 0
+        file_line_count = 0
+        
+        for lines, chunk_lines, counts, values, rapid, feed, after_circle, circle, paint_lines, chunk_tool_lines, chunk_line_count in chunks:
+            chunk_starts.append(line_count)
+            record_lines.append(chunk_lines + line_count)
+            tool_lines.append(chunk_tool_lines + line_count)
+            line_numbers.append(np.delete(np.arange(1, chunk_line_count + 1), paint_lines) + file_line_count)
+            other_lines.extend(lines)
+            line_count += len(lines) + len(chunk_lines)
+            file_line_count += chunk_line_count
+        
+        record_lines = np.concatenate(record_lines)
+        record_circle = np.concatenate([chunk[7] for chunk in chunks])
+        
+        # Put the lines back together, a parsed record only keeps its command
+        is_record = np.zeros(line_count, dtype=bool)
+        is_record[record_lines] = True
+        CLSF = np.empty(line_count, dtype=object)
+        CLSF[is_record] = np.array(['GOTO', 'CIRCLE'], dtype=object)[record_circle.astype(np.intp)]
+        CLSF[~is_record] = np.array(other_lines, dtype=object)
+        self.CLSF = CLSF.tolist()
+        self.line_numbers = np.concatenate(line_numbers)
+        self.tool_lines = np.concatenate(tool_lines).tolist()
+        
+        record_offsets = np.zeros(len(record_lines) + 1, dtype=np.int64)
+        np.cumsum(np.concatenate([chunk[2] for chunk in chunks]), out=record_offsets[1:])
+        record_rapid = np.concatenate([chunk[4] for chunk in chunks])
+        record_feed = np.concatenate([chunk[5] for chunk in chunks])
+        record_after_circle = np.concatenate([chunk[6] for chunk in chunks])
+        
+        # Resolve the context of the records on the first two lines of a chunk with the lines
+        # at the end of the previous chunk
+        for chunk_start in chunk_starts[1:]:
+            first = np.searchsorted(record_lines, chunk_start)
+            last = np.searchsorted(record_lines, chunk_start + 2)
+            
+            for row in range(first, last):
+                line = record_lines[row]
+                rapid, feed, after_circle = CLSF_Data.line_context(self.CLSF[line - 1], self.CLSF[line - 2])
+                record_rapid[row] = rapid
+                record_feed[row] = math.nan if feed is None else feed
+                record_after_circle[row] = after_circle
+        
+        self.record_arrays = (record_lines, record_offsets, np.concatenate([chunk[3] for chunk in chunks]),
+                              record_rapid, record_feed, record_after_circle)
+    
+    # Turns the merged record arrays into lists, once, as the translator reads a record at a time
+    def load_records(self):
+        lines, offsets, values, rapid, feed, after_circle = self.record_arrays
+        
+        self.record_lines = lines.tolist()
+        self.record_offsets = offsets.tolist()
+        self.record_values = values.tolist()
+        self.record_rapid = rapid.tolist()
+        self.record_feed = feed.tolist()
+        self.record_after_circle = after_circle.tolist()
+    
+    # Returns the row of a line in the records, None if the line was not parsed ahead
+    # The records are mostly read in order, so the row after the last one read is tried first
+    def record_row(self, line):
+        if self.record_arrays is None:
+            return None
+        
+        if self.record_lines is None:
+            self.load_records()
+            
+        lines = self.record_lines
+        row = self.record_cursor
+        
+        if row >= len(lines) or lines[row] != line:
+            row = bisect.bisect_left(lines, line)
+            
+            if row == len(lines) or lines[row] != line:
+                return None
+        
+        self.record_cursor = row + 1
+        return row
+    
+    # --------------------------------------------------------------------------------------------
+    
+    # Scan and index all tools and operations
+    def index_operations(self):
+        operation_count = 0
+        tool_count = 1
+        tool_name_to_number = {}
+        
+        # The TOOL PATH lines are already found if the file was parsed in chunks (See parse_chunk)
+        if self.tool_lines is None:
+            self.tool_lines = [line_count for line_count, line in enumerate(self.CLSF) if 'TOOL PATH' in line]
+        
+        # For every tool change...
+        for line_count in self.tool_lines:
+            operation_count += 1
+            # Make the tool object
+            tool = Tool(self.CLSF, line_count)
+            tool.line_start = line_count
+            tool.operation_number = operation_count
+            
+            # Add to tool dictionary
+            if tool.tool_name not in tool_name_to_number:
+                tool_name_to_number[tool.tool_name] = tool_count
+                tool.tool_number = tool_count
+                self.tools[tool_count] = tool
+                tool_count += 1
+                
+            # Adding Tool Number to tool
+            if tool.tool_name in tool_name_to_number:
+                tool.tool_number = tool_name_to_number[tool.tool_name]
+            
+            # Index the new operation with that tool number
+            self.operations[operation_count] = tool
+                
+        self.total_operations = operation_count
+    
+    # Returns the values of a GOTO or CIRCLE line as a list of floats
+    def values(self, line):
+        row = self.record_row(line)
+        
+        if row is not None:
+            return self.record_values[self.record_offsets[row]:self.record_offsets[row + 1]]
+        
+        return [float(i) for i in self.CLSF[line].split('/')[1].split(',')]
+    
+    # Returns a GOTO or CIRCLE line with its context: (values, rapid, feed, after_circle)
+    def record(self, line):
+        row = self.record_row(line)
+        
+        if row is None:
+            rapid, feed, after_circle = CLSF_Data.line_context(self.CLSF[line - 1], self.CLSF[line - 2])
+            return self.values(line), rapid, feed, after_circle
+        
+        values = self.record_values[self.record_offsets[row]:self.record_offsets[row + 1]]
+        feed = self.record_feed[row]
+        
+        return values, self.record_rapid[row], None if math.isnan(feed) else feed, self.record_after_circle[row]
+        
+# Returns the printed value of a G-Code word (E.g. 1.5 -> '1.5000'), printed with %.4f like the
+# G-Code always was, but a rounded zero is never printed as -0.0000. Words are compared as printed,
+# so a word is only output if its G-Code changes.
+def g_code_word(value):
+    word = f"{value:.4f}"
+    
+    if word == "-0.0000":
+        return "0.0000"
+    
+    return word
         
 # This is our CLSF to G-Code Translator
 class CLSF_to_GCode():
     CLSF = []
-    g_code = []
-    current_coord = [0,0,0,0,0,1]
-    current_coord_gcode = [0,0,0,0,0,0]
     n_index = 5
     CLSF_line_count = 0
-    tools = {}
     DWO = False
     beta = 0
     gamma = 0
     
-    # Key is operation number, value the tool
-    operations = {}
     current_operation = 0
     total_operations = 0 # total number of operations 
     first_operation_move = False # First move of an operation 
     
-    # HAAS UMC750 Parameters
-    B_limit = True
-    min_B_rotation = -35 # degrees
-    max_B_rotation = 110 # degrees
-    Z_limit = False
-    
     # Current motion
     current_motion = 'G01'
     axes_lock = True
+    
+    # Subprograms
+    subprogram_mode = None # None (one program), 'M97' (local) or 'M98' (external)
+    subprogram_start = 1000 # M98 program numbers are subprogram_start + 100 * operation + chunk
+    max_subprogram_blocks = None # Longer operations are split into several subprograms
+    in_subprogram = False
+    subprogram_chunk = 0
+    modal_reset = False # Next move outputs every word so the subprogram can run on its own
+    arc_blocks = 3 # Most blocks an arc outputs: positioning block of a subprogram, helix Z and the arc
+    
+    # Operation reordering
+    reorder = False # Group operations by tool to avoid tool changes
+    order_constraints = () # List of (before, after) operation name patterns
+    
+    # Batched translation
+    batched = False # Rotate the moves of a batch of CLSF commands at once
+    batch_size = 1024 # CLSF commands in a batch
+    
+    # Parameters:
+    # machine (Machine) : Machine profile to post for, the HAAS UMC750 if not given
+    # clsf (CLSF_Data) : Parsed CLSF file, may be shared with other translators
+    # subprogram_mode (String) : Write every operation to its own 'M97' or 'M98' subprogram
+    # max_subprogram_blocks (Int) : Maximum number of blocks in a subprogram
+    # reorder (Boolean) : Group operations by tool (See reorder_operations)
+    # order_constraints (List of (String, String)) : Operations matching the first pattern stay
+    #                                                before operations matching the second
+    # trace (Boolean) : Record which CLSF line every block comes from (See source_line)
+    # batched (Boolean) : Translate in batches of CLSF commands (See translate_batched)
+    def __init__(self, machine=None, clsf=None, subprogram_mode=None, max_subprogram_blocks=None,
+                 reorder=False, order_constraints=(), trace=False, batched=False):
+        self.machine = machine if machine else Machine()
+        self.subprogram_mode = subprogram_mode
+        self.max_subprogram_blocks = max_subprogram_blocks
+        
+        # A subprogram must hold its header, the blocks of any first move and the M99
+        if max_subprogram_blocks is not None and max_subprogram_blocks < self.arc_blocks + 2:
+            raise ValueError(f"Subprograms need at least {self.arc_blocks + 2} blocks")
+        
+        self.reorder = reorder
+        self.order_constraints = order_constraints
+        self.batched = batched
+        self.g_code = []
+        self.main_g_code = self.g_code
+        
+        # List of (number of blocks, CLSF line) before every translated CLSF command, None if not traced
+        # Every program has its own trace, the trace of the program being written is self.trace
+        self.trace = [] if trace else None
+        self.main_trace = self.trace
+        
+        # List of (program number or label, G-Code) of the subprograms
+        self.subprograms = []
+        self.subprogram_traces = [] # Trace of every subprogram, in the order of subprograms
+        self.current_coord = [0,0,0,0,0,1]
+        self.current_coord_gcode = [0,0,0,0,0,0]
+        self.current_words = ["0.0000","0.0000","0.0000"] # current_coord X, Y, Z as printed
+        self.current_feed = None # Last feed output
+        self.tools = {}
+        
+        # Key is operation number, value the tool
+        self.operations = {}
+        
+        if clsf:
+            self.load(clsf)
+    
+    def load(self, clsf):
+        self.clsf = clsf
+        self.CLSF = clsf.CLSF
+        self.tools = clsf.tools
+        self.operations = clsf.operations
+        self.total_operations = clsf.total_operations
+        
+        # Renumber the operations in their new order, tool changes and pre-staging follow it
+        if self.reorder:
+            order = reorder_operations(clsf.operations, self.order_constraints)
+            self.operations = {}
+            
+            for operation, original_operation in enumerate(order, 1):
+                self.operations[operation] = clsf.operations[original_operation]
+    
+    # Returns the line numbers of the CLSF file in the order they are translated
+    def line_order(self):
+        if not self.reorder or not self.operations:
+            return range(len(self.CLSF))
+        
+        # Every operation runs from its TOOL PATH line to the next one
+        starts = sorted(tool.line_start for tool in self.clsf.operations.values())
+        ends = dict(zip(starts, starts[1:] + [len(self.CLSF)]))
+        
+        ranges = [range(starts[0])]
+        
+        for operation in range(1, len(self.operations) + 1):
+            start = self.operations[operation].line_start
+            ranges.append(range(start, ends[start]))
+            
+        return itertools.chain(*ranges)
         
     def n_index_return(self):
         index = self.n_index
@@ -146,6 +600,10 @@ class CLSF_to_GCode():
         
     def new_operation(self):
         
+        # Operation headers and tool changes stay in the main program
+        self.close_subprogram()
+        self.subprogram_chunk = 0
+        
         self.current_operation += 1
         
         tool = self.operations[self.current_operation]
@@ -156,7 +614,7 @@ class CLSF_to_GCode():
         if self.current_operation == 1:
             self.tool_table()
             self.g_code.append("")
-            self.g_code.append(f"N{self.n_index_return()} G40 G17 G94 G98 G90 G00 G49 G20)")
+            self.g_code.append(f"N{self.n_index_return()} {self.machine.safe_start}")
             self.g_code.append("")
             self.g_code.append(f"( *** TOOL CHANGE: T{tool.tool_number:02d}: {tool.tool_name} *** )")
             self.g_code.append("")
@@ -227,7 +685,16 @@ class CLSF_to_GCode():
     def load_tool(self):
         
         current_tool_number = self.operations[self.current_operation].tool_number
-        current_tool_speed = self.operations[self.current_operation].speed
+        current_tool_speed = self.machine.speeds.get(self.operations[self.current_operation].tool_name)
+        
+        # Operations grouped by tool (See reorder_operations) keep the tool loaded and spinning, and
+        # the next tool is already pre-staged, so only retract. Without reordering every operation
+        # keeps its tool change and M01 optional stop.
+        if self.reorder and self.current_operation > 1 and current_tool_number == self.operations[self.current_operation - 1].tool_number:
+            self.g_code.append(f"N{self.n_index_return()} G53 G00 Z0.0")
+            self.g_code.append(f"N{self.n_index_return()} G17 {self.machine.work_offset} G90")
+            return
+        
         self.g_code.append(f"N{self.n_index_return()} T{current_tool_number} M06")
         
         if self.current_operation + 1 in self.operations:     
@@ -245,12 +712,105 @@ class CLSF_to_GCode():
         # self.current_coord[2] = 0
         # self.current_coord_gcode[2] = 0
         self.g_code.append(f"N{self.n_index_return()} S{current_tool_speed} M03")
-        self.g_code.append(f"N{self.n_index_return()} G17 G54 G90")
+        self.g_code.append(f"N{self.n_index_return()} G17 {self.machine.work_offset} G90")
+        
+        # Tool length compensation stays active until the next tool change
+        compensation = self.machine.tool_compensation.get(self.operations[self.current_operation].tool_name)
+        
+        if self.machine.tool_length_compensation and compensation:
+            self.g_code.append(f"N{self.n_index_return()} {compensation} H{current_tool_number}")
+        
+
+    # Called before every move, moves go to the subprogram of the operation
+    # Parameters:
+    # blocks (Int) : Number of blocks the move may add
+    def subprogram_move(self, blocks):
+        if not self.in_subprogram:
+            self.open_subprogram()
+            
+        # Room for this move and the M99
+        elif self.max_subprogram_blocks and len(self.g_code) + blocks + 1 > self.max_subprogram_blocks:
+            self.close_subprogram()
+            self.open_subprogram()
+    
+    def open_subprogram(self):
+        tool = self.operations[self.current_operation]
+        
+        if self.subprogram_mode == 'M97':
+            # Local subprogram, the label is a block number of this program 
+            call = self.n_index_return()
+            number = self.n_index_return()
+            self.main_g_code.append(f"N{call} M97 P{number}")
+            self.g_code = [f"N{number} ( OPER: {tool.tool_path} )"]
+            
+        else:
+            # External subprogram, numbered by the operation in the CLSF file so unchanged operations
+            # keep their program, in any order
+            if self.subprogram_chunk >= 100:
+                raise ValueError(f"Operation {tool.tool_path} needs more than 100 subprograms")
+            
+            number = self.subprogram_start + 100 * tool.operation_number + self.subprogram_chunk
+            
+            if number > 99999:
+                raise ValueError(f"Operation {tool.tool_path} has no M98 program number left")
+            
+            self.main_g_code.append(f"N{self.n_index_return()} M98 P{number}")
+            self.main_n_index = self.n_index
+            self.n_index = 5
+            self.g_code = [f"O{number:05d} ( OPER: {tool.tool_path} )"]
+        
+        self.subprograms.append((number, self.g_code))
+        
+        # The blocks before the first CLSF command of the subprogram come from the move that opened it
+        if self.trace is not None:
+            self.trace = [(0, self.CLSF_line_count)]
+            self.subprogram_traces.append(self.trace)
+            
+        self.subprogram_chunk += 1
+        self.in_subprogram = True
+        self.modal_reset = True
+    
+    def close_subprogram(self):
+        if not self.in_subprogram:
+            return
+        
+        self.g_code.append(f"N{self.n_index_return()} M99")
+        
+        if self.subprogram_mode == 'M98':
+            self.n_index = self.main_n_index
+            
+        self.g_code = self.main_g_code
+        self.trace = self.main_trace
+        self.in_subprogram = False
+    
+    # Local subprograms go after the end of the main program
+    def end_subprograms(self):
+        self.close_subprogram()
         
+        if self.subprogram_mode == 'M97':
+            self.g_code.append(f"N{self.n_index_return()} M30")
+            
+            for chunk, (number, g_code) in enumerate(self.subprograms):
+                self.g_code.append("")
+                
+                if self.trace is not None:
+                    self.trace.extend((len(self.g_code) + block, line) for block, line in self.subprogram_traces[chunk])
+                    
+                self.g_code.extend(g_code)
 
 # Given the target coordinates with tool axis vector
 # Returns rotation B and C rotations (beta, gamma angles in degrees)
     def rotate(self, target_coord):
+        beta, gamma = self.tool_axis_rotation(target_coord)
+                
+        if self.machine.B_limit and (beta < self.machine.min_B_rotation or beta > self.machine.max_B_rotation):
+            gamma = gamma - 180
+            beta = -beta
+        
+        
+        return beta, gamma 
+    
+    def tool_axis_rotation(self, target_coord):
         beta = 90 
         gamma = 90
         r2d = 180/math.pi
@@ -264,7 +824,7 @@ class CLSF_to_GCode():
             try:
                 beta = abs(math.atan(target_coord[4]/target_coord[5])) * r2d
             except:
-                print(CLSF_to_GCode.CLSF[self.CLSF_line_count])
+                print(self.CLSF[self.CLSF_line_count])
                 raise("Please don't let me come here")
             
             if target_coord[4] < 0:
@@ -282,22 +842,49 @@ class CLSF_to_GCode():
             
             if target_coord[3] < 0:
                 beta = -beta
-                
-        if beta < -35 or beta > 120:
-            gamma = gamma - 180
-            beta = -beta
         
+        return beta, gamma
         
-        return beta, gamma 
+    
+    def linear(self, rapid, feed, target_coord, after_circle):
         
+        rotate, old_beta, old_gamma = self.orient(target_coord)
+            
+        if rotate:
+            target_coord = self.rotate_coord(target_coord)
+            
+        return self.linear_block(rapid, feed, target_coord, after_circle, old_beta, old_gamma, self.beta, self.gamma)
     
-    def linear(self, rapid, feed, target_coord):
+    # Updates the B and C rotations (beta, gamma) for a linear move
+    # Returns (rotate, old_beta, old_gamma), rotate is True if the move must go through rotate_coord
+    def orient(self, target_coord):
+        
+        rotate = True
+            
+        if len(target_coord) > 3:
+            i = target_coord[3]
+            j = target_coord[4]
+            k = target_coord[5]
+            
+            if i == 0 and j == 0 and k == 1:
+                rotate = False
+                self.beta = 0
+                self.gamma = 0
+                
+        old_beta = self.beta
+        old_gamma = self.gamma
+            
+        if len(target_coord) > 3 and rotate:
+                self.beta, self.gamma = self.rotate(target_coord)
+                
+        return rotate, old_beta, old_gamma
+    
+    # Outputs the block of a linear move, target_coord is already rotated
+    def linear_block(self, rapid, feed, target_coord, after_circle, old_beta, old_gamma, beta, gamma):
         
-        target_coord = target_coord
         motion = None
         motion_change = False
         skip = 0
-        rotate = False
         
         # Handles motion change commands (E.g. G00, G01)
         if rapid:
@@ -310,81 +897,66 @@ class CLSF_to_GCode():
         else:
             self.current_motion = motion
             
-        check_circle_line = CLSF_to_GCode.CLSF[self.CLSF_line_count-2]
-        if 'CIRCLE' in check_circle_line:
+        if after_circle:
             motion_change = True
             motion = 'G01'
             self.current_motion = motion
             
         # if self.CLSF_line_count < 30:
         #     print(target_coord)
-            
-        rotate = True
-            
-        if len(target_coord) > 3:
-            i = target_coord[3]
-            j = target_coord[4]
-            k = target_coord[5]
-            
-            if i == 0 and j == 0 and k == 1:
-                rotate = False
-                self.beta = 0
-                self.gamma = 0
-                
-        old_beta = self.beta
-        old_gamma = self.gamma
-            
-        if len(target_coord) > 3 and rotate:
-                self.beta, self.gamma = self.rotate(target_coord)
-            
-        if rotate:
-            target_coord = self.rotate_coord(target_coord)
         
-        x = True
-        y = True
-        z = True
-                    
-        if self.current_coord[0] == target_coord[0]:
-            x = False
+        # Words are compared as printed, so a word is only output if its G-Code changes.
+        # A value is only printed again if it changed.
+        word = g_code_word
+        current_coord = self.current_coord
+        current_words = self.current_words
+        
+        x_word = current_words[0] if target_coord[0] == current_coord[0] else word(target_coord[0])
+        y_word = current_words[1] if target_coord[1] == current_coord[1] else word(target_coord[1])
+        z_word = current_words[2] if target_coord[2] == current_coord[2] else word(target_coord[2])
+        
+        x = x_word != current_words[0]
+        y = y_word != current_words[1]
+        z = z_word != current_words[2]
+        b = False
+        
+        if old_beta != beta or old_gamma != gamma:
+            b = word(old_beta) != word(beta) or word(old_gamma) != word(gamma)
             
-        if self.current_coord[1] == target_coord[1]:
-            y = False
+        feed_word = feed
             
-        if self.current_coord[2] == target_coord[2]:
-            z = False
+        # First move of a subprogram, don't rely on the modal state of the caller
+        if self.modal_reset:
+            motion_change = True
+            x = y = z = b = True
+            feed_word = feed or self.current_feed
+            self.modal_reset = False
             
         string = f"N{self.n_index_return()} "
         
         if motion_change:
-            string = string + f"{motion} "
+            string = string + motion + " "
             
         if x:
-            string = string + f"X{target_coord[0]:.4f} "
+            string = string + "X" + x_word + " "
             
         if y:
-            string = string + f"Y{target_coord[1]:.4f} "
+            string = string + "Y" + y_word + " "
             
         if z:
-            string = string + f"Z{target_coord[2]:.4f} "
-            
-        if old_beta != self.beta or old_gamma != self.gamma:
-            string = string + f"B{self.beta:.4f} "
+            string = string + "Z" + z_word + " "
             
-        if old_beta != self.beta or old_gamma != self.gamma: 
-            string = string + f"C{self.gamma:.4f} "
-        
-        # if self.beta:
-        #     string = string + f"B{self.beta:.4f} "
+        if b:
+            string = string + "B" + word(beta) + " C" + word(gamma) + " "
             
-        # if self.gamma: 
-        #     string = string + f"C{self.gamma:.4f} "
-            
-        if feed:
-            string = string + f"F{feed:.4f} "
+        if feed_word:
+            string = string + "F" + word(feed_word) + " "
+            self.current_feed = feed_word
             
         self.g_code.append(string)
             
         self.current_coord = target_coord
+        self.current_words = [x_word, y_word, z_word]
         
         if rapid or feed:
             skip = 1
@@ -398,18 +970,16 @@ class CLSF_to_GCode():
         
         skip = 1
         current_line = self.CLSF_line_count
-        previous_line = current_line - 1
         next_line = current_line + 1
         
+        if self.subprogram_mode:
+            self.subprogram_move(self.arc_blocks)
         
-        target_coord = CLSF_to_GCode.CLSF[next_line].split('/')
-        target_coord = target_coord[1].split(',')
-        target_coord = [float(i) for i in target_coord]
+        
+        target_coord = self.clsf.values(next_line)
         target_coord = self.rotate_coord(target_coord)
         
-        circle_params = CLSF_to_GCode.CLSF[current_line].split('/')
-        circle_params = circle_params[1].split(',')
-        circle_params = [float(i) for i in circle_params]
+        circle_params, rapid, feed, after_circle = self.clsf.record(current_line)
         
         center_coord = [circle_params[0],circle_params[1],circle_params[2]]
         
@@ -418,6 +988,26 @@ class CLSF_to_GCode():
         
         radius = circle_params[6]
         
+        self.circular_block(feed, target_coord, center_coord, radius, self.beta, self.gamma)
+        
+        return skip
+    
+    # Outputs the blocks of an arc, target_coord and center_coord are already rotated
+    def circular_block(self, feed, target_coord, center_coord, radius, beta, gamma):
+        
+        # First move of a subprogram, position on the start of the arc with the modal feed
+        # so the subprogram doesn't rely on the modal state of the caller
+        if self.modal_reset:
+            word = g_code_word
+            string = f"N{self.n_index_return()} G01 X{self.current_words[0]} Y{self.current_words[1]} Z{self.current_words[2]} B{word(beta)} C{word(gamma)} "
+            
+            if self.current_feed:
+                string = string + f"F{word(self.current_feed)} "
+                
+            self.g_code.append(string)
+            self.current_motion = 'G01'
+            self.modal_reset = False
+        
         x_center = center_coord[0]
         y_center = center_coord[1]
         
@@ -429,45 +1019,43 @@ class CLSF_to_GCode():
         x_diff =  x_center - x_start
         y_diff = y_center - y_start
         
-        feed = None 
-        
         clockwise = self.arc_direction_clockwise(x_start,y_start,x_end,y_end,x_center,y_center,radius)
         
         if not clockwise:
             self.current_motion = "G03"
             
-        if 'FEDRAT' in CLSF_to_GCode.CLSF[previous_line]:
-            line = CLSF_to_GCode.CLSF[previous_line].split(',')
-            feed = float(line[1])
+        word = g_code_word
+        target_words = [word(target_coord[0]), word(target_coord[1]), word(target_coord[2])]
             
         # -------------------------------------------------------------------------
         # This is a cheater method for dealing with helixes... We can add a helix
         # fnction in a future release
-        if self.current_coord[2] != target_coord[2]:
-            string = f"N{self.n_index_return()} G01 Z{target_coord[2]:.4f} " 
+        if self.current_words[2] != target_words[2]:
+            string = f"N{self.n_index_return()} G01 Z{target_words[2]} " 
             if feed:
-                string = string + f"F{feed:.4f} "
+                string = string + f"F{word(feed)} "
+                self.current_feed = feed
             self.g_code.append(string)
             feed = None 
         # -------------------------------------------------------------------------
             
         string = f"N{self.n_index_return()} "
-            
+        
         if clockwise:
             string = string + "G02 "
         else:
             string = string + "G03 "
             
-        string = string + f"X{target_coord[0]:.4f} Y{target_coord[1]:.4f} I{x_diff:.4f} J{y_diff:.4f} "
+        string = string + f"X{target_words[0]} Y{target_words[1]} I{word(x_diff)} J{word(y_diff)} "
             
         if feed:
-            string = string + f"F{feed:.4f} "
+            string = string + f"F{word(feed)} "
+            self.current_feed = feed
             
         self.g_code.append(string)
             
         self.current_coord = target_coord
-        
-        return skip
+        self.current_words = target_words
     
     def arc_direction_clockwise(self,x_start,y_start,x_end,y_end,x_center,y_center,radius):
         
@@ -550,39 +1138,29 @@ class CLSF_to_GCode():
         
     def go_to(self):
         current_line = self.CLSF_line_count
-        previous_line = current_line - 1
         # next_line = current_line + 1
         
         try:
-            target_coord = CLSF_to_GCode.CLSF[current_line].split('/')
-            target_coord = target_coord[1].split(',')
-            target_coord = [float(i) for i in target_coord]
+            target_coord, rapid, feed, after_circle = self.clsf.record(current_line)
         except:
-            print(CLSF_to_GCode.CLSF[current_line])
+            print(self.CLSF[current_line])
         
-        rapid = False
-        feed = None
         # circle = False
         
-        
-        if 'RAPID' in CLSF_to_GCode.CLSF[previous_line]:
-            rapid = True
-            
-        if 'FEDRAT' in CLSF_to_GCode.CLSF[previous_line]:
-            line = CLSF_to_GCode.CLSF[previous_line].split(',')
-            feed = float(line[1])
+        if self.subprogram_mode:
+            self.subprogram_move(1)
             
-        # if 'CIRCLE' in CLSF_to_GCode.CLSF[next_line]:
+        # if 'CIRCLE' in self.CLSF[next_line]:
         #     circle = True
         #     self.circular(target_coord, next_line, feed)
             
-        # if 'FEDRAT' in CLSF_to_GCode.CLSF[next_line]:
-        #     if 'CIRCLE' in CLSF_to_GCode.CLSF[next_line + 1]:
+        # if 'FEDRAT' in self.CLSF[next_line]:
+        #     if 'CIRCLE' in self.CLSF[next_line + 1]:
         #         circle = True
         #         self.circular(target_coord, next_line + 1, feed) 
 
         # if not circle:
-        self.linear(rapid, feed, target_coord)
+        self.linear(rapid, feed, target_coord, after_circle)
             
     
     def start(self):
@@ -590,61 +1168,22 @@ class CLSF_to_GCode():
     
     # Parameters:
     # CLSF_path (String) : Path of the CLSF File
-    def parse_CLSF(self, CLSF_path):
-        
-        # Open and turn CLSF file into list of strings (by line)
-        with open(CLSF_path) as CLSF_File:
-            unstripped_CLSF = CLSF_File.readlines()
-            CLSF_to_GCode.CLSF = [line.strip() for line in unstripped_CLSF]
-        
-        CLSF_to_GCode.CLSF = [line for line in CLSF_to_GCode.CLSF if not 'PAINT' in line]
-        CLSF_to_GCode.CLSF = [line.split('$')[0] for line in CLSF_to_GCode.CLSF]
-            
-        # Scan and index all tools and operations --------------------------------------------
-        operation_count = 0
-        line_count = 0
-        tool_count = 1
-        tool_name_to_number = {}
-        
-        for line in CLSF_to_GCode.CLSF:
-            # If we are changing tool...
-            if 'TOOL PATH' in line:
-                operation_count += 1
-                # Make the tool object
-                tool = Tool(line_count)
-                tool.line_start = line_count
-                
-                # Add to tool dictionary
-                if tool.tool_name not in tool_name_to_number:
-                    tool_name_to_number[tool.tool_name] = tool_count
-                    tool.tool_number = tool_count
-                    self.tools[tool_count] = tool
-                    tool_count += 1
-                    
-                # Adding Tool Number to tool
-                if tool.tool_name in tool_name_to_number:
-                    tool.tool_number = tool_name_to_number[tool.tool_name]
-                
-                # Index the new operation with that tool number
-                self.operations[operation_count] = tool
-                
-            self.total_operations = operation_count
-            line_count += 1
-            # self.CLSF_line_count = line_count
-            
-        # # test
-        # for key in self.operations:
-        #     print(f"operation {key}: tool name: {self.operations[key].tool_name}")
-        # for key in self.tools:
-        #     print(f"tool {key}: tool name: {self.tools[key].tool_name}")
-        # #---------------
-                
-
-        # ------------------------------------------------------------------------------------            
+    # workers (Int) : Number of processes parsing the file, one process if not given
+    def parse_CLSF(self, CLSF_path, workers=None):
+        self.load(CLSF_Data(CLSF_path, workers))
+        self.translate()
+    
+    # Translate the loaded CLSF file into G-Code
+    def translate(self):
+        if self.batched:
+            self.translate_batched()
+            return
         
         skip = 0
             
-        for line in self.CLSF:
+        for line_count in self.line_order():
+            self.CLSF_line_count = line_count
+            line = self.CLSF[line_count]
             
             for key in self.dictionary:
                 if skip:
@@ -652,103 +1191,644 @@ class CLSF_to_GCode():
                     break
                 
                 if key in line:
+                    if self.trace is not None:
+                        self.trace.append((len(self.g_code), line_count))
+                        
                     skip = self.dictionary[key](self)
                     break
+            
+        if self.subprogram_mode:
+            self.end_subprograms()
+            
+    # Batched Translation ------------------------------------------------------------------------
+    # Splits the CLSF commands into batches, finds the B and C rotations of every move of a batch,
+    # rotates them in one numpy call (See rotate_coords) then outputs the blocks in order. beta and
+    # gamma are found a batch ahead of the output, so only rotate_batch may use them.
+    
+    def translate_batched(self):
+        for batch in self.command_batches():
+            self.output_batch(self.rotate_batch(batch))
+            
+        if self.subprogram_mode:
+            self.end_subprograms()
+    
+    # Splits the CLSF commands in the order they are translated, with the same skips as translate
+    # Yields batches, lists of (command, CLSF line, command values)
+    def command_batches(self):
+        tools = {tool.line_start: tool for tool in self.operations.values()}
+        batch = []
+        skip = 0
+        
+        for line_count in self.line_order():
+            if skip:
+                skip -= 1
+                continue
+            
+            line = self.CLSF[line_count]
+            
+            for key in self.dictionary:
+                if key in line:
+                    if key == 'GOTO':
+                        batch.append((key, line_count, self.clsf.record(line_count)))
+                        
+                    elif key == 'CIRCLE':
+                        batch.append((key, line_count, (self.clsf.record(line_count), self.clsf.values(line_count + 1))))
+                        skip = 1
+                        
+                    else:
+                        batch.append((key, line_count, None))
+                        
+                        if key == 'TOOL PATH':
+                            skip = tools[line_count].line_skip
+                    break
+                
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+                
+        yield batch
+    
+    # Finds the B and C rotations of every move in order, then rotates the whole batch at once
+    # Returns a list of [command, CLSF line, values...] ready for output_batch
+    def rotate_batch(self, batch):
+        moves = []
+        
+        # (move, position in the move, coordinates, beta, gamma) of every coordinate to rotate
+        rotations = []
+        
+        for key, line_count, values in batch:
+            if key == 'GOTO':
+                target_coord, rapid, feed, after_circle = values
+                rotate, old_beta, old_gamma = self.orient(target_coord)
+                
+                if rotate:
+                    rotations.append((len(moves), 4, target_coord, self.beta, self.gamma))
+                    
+                moves.append([key, line_count, rapid, feed, target_coord, after_circle, old_beta, old_gamma, self.beta, self.gamma])
+                
+            elif key == 'CIRCLE':
+                (circle_params, rapid, feed, after_circle), target_coord = values
+                center_coord = [circle_params[0],circle_params[1],circle_params[2]]
+                rotations.append((len(moves), 3, target_coord, self.beta, self.gamma))
+                
+                if self.beta != 0 or self.gamma != 0:
+                    rotations.append((len(moves), 4, center_coord, self.beta, self.gamma))
+                    
+                moves.append([key, line_count, feed, target_coord, center_coord, circle_params[6], self.beta, self.gamma])
+                
+            else:
+                moves.append([key, line_count])
+                
+        if rotations:
+            coords = np.array([coord[:3] for move, position, coord, beta, gamma in rotations], dtype=np.float64)
+            betas = np.array([beta for move, position, coord, beta, gamma in rotations], dtype=np.float64)
+            gammas = np.array([gamma for move, position, coord, beta, gamma in rotations], dtype=np.float64)
+            rotated = CLSF_to_GCode.rotate_coords(coords, betas, gammas).tolist()
+            
+            for (move, position, coord, beta, gamma), rotated_coord in zip(rotations, rotated):
+                moves[move][position] = rotated_coord + coord[3:]
+                
+        return moves
+    
+    # Outputs a batch in order
+    def output_batch(self, batch):
+        for move in batch:
+            key = move[0]
+            line_count = move[1]
+            self.CLSF_line_count = line_count
+            
+            if self.trace is not None:
+                self.trace.append((len(self.g_code), line_count))
+                
+            if key == 'GOTO':
+                if self.subprogram_mode:
+                    self.subprogram_move(1)
+                
+                self.linear_block(*move[2:])
+                
+            elif key == 'CIRCLE':
+                if self.subprogram_mode:
+                    self.subprogram_move(self.arc_blocks)
                     
-            self.CLSF_line_count = self.CLSF_line_count + 1
+                self.circular_block(*move[2:])
+                
+            else:
+                self.dictionary[key](self)
+    
+    # --------------------------------------------------------------------------------------------
+            
+    # Returns the line in the CLSF file a block comes from, needs trace
+    # Blocks are counted through the main program then the external subprograms (See program_blocks)
+    def source_line(self, block):
+        trace = self.trace
+        
+        if self.subprogram_mode == 'M98':
+            trace = list(self.trace)
+            first_block = len(self.g_code)
+            
+            for (number, g_code), subprogram_trace in zip(self.subprograms, self.subprogram_traces):
+                trace.extend((first_block + block, line) for block, line in subprogram_trace)
+                first_block += len(g_code)
+        
+        mark = bisect.bisect_right(trace, (block, math.inf)) - 1
+        
+        if mark < 0:
+            return None
+        
+        return int(self.clsf.line_numbers[trace[mark][1]])
             
     def end_of_path(self):
+        # Operation footers stay in the main program, like the headers
+        self.close_subprogram()
         self.g_code.append(f"N{self.n_index_return()} G255")
     
     
     
-    def rotate_z_transform(self, target_coord, gamma):
-        
-        target_coord_result = target_coord[:]
+    # Commands Dictionary
+    dictionary = {}
+    dictionary['TOOL PATH'] = new_operation
+    dictionary['LOAD/TOOL'] = load_tool
+    dictionary['GOTO'] = go_to
+    dictionary['CIRCLE'] = circular
+    dictionary['END-OF-PATH'] = end_of_path
+    
+    # Rotates a coordinate into the machine frame, about Z by the C rotation then about Y by the
+    # B rotation, the same closed form as rotate_coords for a single coordinate
+    def rotate_coord(self,targ_coord):
+        beta = math.radians(self.beta)
+        gamma = math.radians(self.gamma - 180)
+        
+        # About Z (C rotation)
+        x = math.cos(gamma) * targ_coord[0] - math.sin(gamma) * targ_coord[1]
+        y = math.sin(gamma) * targ_coord[0] + math.cos(gamma) * targ_coord[1]
+        z = targ_coord[2]
+        
+        # About Y (B rotation)
+        final_coord = targ_coord[:]
+        final_coord[0] = -(math.cos(beta) * x + math.sin(beta) * z)
+        final_coord[1] = -y
+        final_coord[2] = -math.sin(beta) * x + math.cos(beta) * z
+        return final_coord 
+    
+    # rotate_coord for a batch, every coordinate with its own rotations
+    # Parameters:
+    # coords (Array n x 3) : X, Y, Z coordinates
+    # betas, gammas (Array n) : B and C rotations in degrees
+    # Returns the rotated coordinates (Array n x 3)
+    @staticmethod
+    def rotate_coords(coords, betas, gammas):
+        beta = np.radians(betas)
+        gamma = np.radians(gammas - 180)
+        
+        # About Z (C rotation)
+        x = np.cos(gamma) * coords[:, 0] - np.sin(gamma) * coords[:, 1]
+        y = np.sin(gamma) * coords[:, 0] + np.cos(gamma) * coords[:, 1]
+        z = coords[:, 2]
+        
+        # About Y (B rotation)
+        rotated = np.empty_like(coords)
+        rotated[:, 0] = -(np.cos(beta) * x + np.sin(beta) * z)
+        rotated[:, 1] = -y
+        rotated[:, 2] = -np.sin(beta) * x + np.cos(beta) * z
+        
+        return rotated
+
+# Operation Reordering -----------------------------------------------------------------------
+
+# Parameters:
+# constraints_path (String) : Path of the constraints file, one "BEFORE < AFTER" per line where
+#                             BEFORE and AFTER are operation name patterns (E.g. "ROUGH* < FINISH*")
+# Returns a list of (before, after) patterns
+def load_order_constraints(constraints_path):
+    constraints = []
+    
+    with open(constraints_path) as constraints_file:
+        for line in constraints_file:
+            line = line.split('#')[0].strip()
+            
+            if not line:
+                continue
+            
+            if '<' not in line:
+                raise ValueError(f"Ordering constraint without '<': {line}")
+            
+            before, after = line.split('<', 1)
+            constraints.append((before.strip(), after.strip()))
+            
+    return constraints
+
+# Orders the operations so operations using the same tool follow each other, while operations
+# matching a constraint's first pattern stay before the ones matching its second pattern.
+# The loaded tool is kept while it has operations ready. Otherwise the next tool is one whose
+# operations left are all ready, so it is never loaded again, else the one that runs the most
+# operations in a row. Operations keep their original order unless that costs a tool change.
+# Parameters:
+# operations (Dictionary) : Key is operation number, value the tool
+# constraints (List of (String, String)) : (before, after) operation name patterns
+# Returns the operation numbers in their new order
+def reorder_operations(operations, constraints):
+    
+    # Key is operation number, value the operations that must come before it
+    predecessors = {operation: set() for operation in operations}
+    
+    for before, after in constraints:
+        first = [n for n in operations if fnmatch.fnmatchcase(operations[n].tool_path, before)]
+        second = [n for n in operations if fnmatch.fnmatchcase(operations[n].tool_path, after)]
         
-        # while gamma < 0:
-        #     gamma = gamma + 360
+        for b in second:
+            predecessors[b].update(a for a in first if a != b)
+    
+    order = []
+    placed = set()
+    remaining = sorted(operations)
+    current_tool = None
+    
+    while remaining:
+        available = [n for n in remaining if predecessors[n] <= placed]
         
-        theta = math.radians(gamma)
+        if not available:
+            raise ValueError("Operation ordering constraints contradict each other")
         
-        rotation_matrix_z = [[math.cos(theta),  -math.sin(theta),       0,      0],
-                            [math.sin(theta),  math.cos(theta),        0,      0],
-                            [0,                0,                      1,      0],
-                            [0,                0,                      0,      1]]
+        # Keep the loaded tool if it has operations left, else change to the best next tool
+        same_tool = [n for n in available if operations[n].tool_number == current_tool]
         
-        rotation_matrix_z = np.array(rotation_matrix_z)
+        if same_tool:
+            operation = same_tool[0]
+        else:
+            tools = []
+            
+            for n in available:
+                if operations[n].tool_number not in tools:
+                    tools.append(operations[n].tool_number)
+                    
+            # max keeps the first of equal tools, the one of the first operation ready
+            tool = max(tools, key=lambda tool: tool_run(operations, predecessors, placed, remaining, tool))
+            operation = next(n for n in available if operations[n].tool_number == tool)
         
-        target_coord_temp = [   [target_coord[0]],
-                                [target_coord[1]],
-                                [target_coord[2]],
-                                [1]]
+        order.append(operation)
+        placed.add(operation)
+        remaining.remove(operation)
+        current_tool = operations[operation].tool_number
         
-        target_coord_temp = np.array(target_coord_temp)
+    return order
+
+# Returns how good a tool is to load next: (True if it runs all its operations left, number of
+# operations it runs in a row before it has none ready)
+def tool_run(operations, predecessors, placed, remaining, tool):
+    placed = set(placed)
+    tool_operations = [n for n in remaining if operations[n].tool_number == tool]
+    run = 0
+    
+    while True:
+        ready = [n for n in tool_operations if n not in placed and predecessors[n] <= placed]
         
-        rotated_coord = np.matmul(rotation_matrix_z, target_coord_temp)
-        rotated_coord = rotated_coord.T
+        if not ready:
+            break
         
-        target_coord_result[0] = rotated_coord[0][0]
-        target_coord_result[1] = rotated_coord[0][1]
-        target_coord_result[2] = rotated_coord[0][2]
+        placed.update(ready)
+        run += len(ready)
         
-        return target_coord_result
+    return run == len(tool_operations), run
+
+# Multiple Machines --------------------------------------------------------------------------
+# Translation is pure Python, so the machines are translated in worker processes to run at the
+# same time. The workers are forked where possible so they start with the parsed CLSF file
+# instead of receiving it.
+
+# Parsed CLSF file and translator options of a posting worker process (See post_initializer)
+post_clsf = None
+post_options = None
+
+def post_initializer(clsf, options):
+    global post_clsf, post_options
+    post_clsf = clsf
+    post_options = options
+
+# Translates the CLSF file for one machine, this runs in a worker process
+# Returns the translator without the CLSF file, which isn't sent back
+def post_machine(machine):
+    translator = CLSF_to_GCode(machine, post_clsf, **post_options)
+    translator.translate()
+    translator.clsf = translator.CLSF = None
+    return translator
+
+# Parameters:
+# clsf (CLSF_Data) : Parsed CLSF file, shared by the translators of all machines
+# machines (List of Machine) : Machine profiles to post for
+# options : Translator options (See CLSF_to_GCode)
+# Returns one translator per machine, in the order of machines
+def post(clsf, machines, **options):
+    if len(machines) < 2:
+        post_initializer(clsf, options)
+        return [post_machine(machine) for machine in machines]
+    
+    context = None
+    
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    
+    with ProcessPoolExecutor(max_workers=len(machines), mp_context=context,
+                             initializer=post_initializer, initargs=(clsf, options)) as executor:
+        return list(executor.map(post_machine, machines))
+
+# Returns the output file of a machine, the given output with the machine name appended if the
+# machine profile does not name one
+def machine_output(machine, output):
+    if machine.output:
+        return machine.output
+    
+    root, extension = os.path.splitext(output)
+    return f"{root}-{machine.name}{extension}"
+
+def write_g_code(g_code, output):
+    with open(output, "w") as g_code_output:
+        for line in g_code:
+            g_code_output.write(line + "\n")
 
-    def rotate_y_transform(self, target_coord, beta):
+# Writes the file only if its content changed, so unchanged subprograms are reused across posts
+# Returns True if the file was written
+def write_g_code_if_changed(g_code, output):
+    text = "".join(line + "\n" for line in g_code)
+    
+    try:
+        with open(output) as g_code_output:
+            if g_code_output.read() == text:
+                return False
+    except FileNotFoundError:
+        pass
+    
+    with open(output, "w") as g_code_output:
+        g_code_output.write(text)
         
-            target_coord_result = target_coord[:]
-            
-            # while beta < 0:
-            #     beta = beta + 360
-            
-            theta = math.radians(beta)
-            
-            rotation_matrix_y = [[math.cos(theta),      0,      math.sin(theta),    0],
-                                [0,                    1,      0,                  0],
-                                [-math.sin(theta),     0,      math.cos(theta),    0],
-                                [0,                    0,      0,                  1]]
-            
-            rotation_matrix_y = np.array(rotation_matrix_y)
-            
-            target_coord_temp = [   [target_coord[0]],
-                                    [target_coord[1]],
-                                    [target_coord[2]],
-                                    [1]]
+    return True
+
+# Writes the main program and, for external (M98) subprograms, one file per subprogram next to it
+def write_program(translator, output):
+    write_g_code(translator.g_code, output)
+    
+    if translator.subprogram_mode != 'M98':
+        return
+    
+    root, extension = os.path.splitext(output)
+    
+    def write_subprogram(subprogram):
+        number, g_code = subprogram
+        return write_g_code_if_changed(g_code, f"{root}-O{number:05d}{extension}")
+    
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(write_subprogram, translator.subprograms))
+
+# Equivalence Check --------------------------------------------------------------------------
+# Compares the G-Code of an engine block by block against golden G-Code, recorded once for every
+# CLSF file with --record. The golden G-Code doesn't change with the translator, so a change in
+# the code shared by all engines is caught too.
+
+# Words compared with a tolerance, every other word must match exactly
+numeric_words = "XYZBCIJF"
+
+# Returns the translator of a CLSF file translated with an engine
+# Parameters:
+# engine (String) : 'serial' (parsed and translated in order), 'parallel' (parsed in worker
+#                   processes) or 'batched' (translated in batches, See translate_batched)
+# options : Translator options (See CLSF_to_GCode)
+def translate_with(engine, CLSF_path, options):
+    batched = False
+    
+    if engine == 'serial':
+        clsf = CLSF_Data(CLSF_path)
+    elif engine == 'parallel':
+        clsf = CLSF_Data(CLSF_path, workers=2)
+    elif engine == 'batched':
+        clsf = CLSF_Data(CLSF_path)
+        batched = True
+    else:
+        raise ValueError(f"Unknown engine: {engine}")
+    
+    options = dict(options)
+    options['batched'] = batched
+    
+    translator = CLSF_to_GCode(clsf=clsf, trace=True, **options)
+    translator.translate()
+    
+    return translator
+
+# Returns the blocks of the main program followed by the blocks of the external subprograms
+def program_blocks(translator):
+    blocks = list(translator.g_code)
+    
+    if translator.subprogram_mode == 'M98':
+        for number, g_code in translator.subprograms:
+            blocks.extend(g_code)
             
-            target_coord_temp = np.array(target_coord_temp)
+    return blocks
+
+def blocks_match(reference_block, optimized_block, tolerance):
+    reference_words = reference_block.split()
+    optimized_words = optimized_block.split()
+    
+    if len(reference_words) != len(optimized_words):
+        return False
+    
+    for reference_word, optimized_word in zip(reference_words, optimized_words):
+        if reference_word == optimized_word:
+            continue
+        
+        if reference_word[0] != optimized_word[0] or reference_word[0] not in numeric_words:
+            return False
+        
+        try:
+            if abs(float(reference_word[1:]) - float(optimized_word[1:])) > tolerance + 1e-9:
+                return False
+        except ValueError:
+            return False
+        
+    return True
+
+# Returns the index of the first block that differs, None if the G-Code is equivalent
+def first_divergence(reference, optimized, tolerance):
+    for block, (reference_block, optimized_block) in enumerate(zip(reference, optimized)):
+        if reference_block != optimized_block and not blocks_match(reference_block, optimized_block, tolerance):
+            return block
+        
+    if len(reference) != len(optimized):
+        return min(len(reference), len(optimized))
+    
+    return None
+
+# Returns the golden G-Code file of a CLSF file
+# Returns the golden G-Code file of a CLSF file for a set of options, named after a short hash of
+# the options (E.g. part.cls.3f2a91c0.golden) so a corpus can hold goldens for several sets
+def golden_path(CLSF_path, options):
+    options_hash = hashlib.sha1(golden_header(options).encode()).hexdigest()[:8]
+    return f"{CLSF_path}.{options_hash}.golden"
+
+# Returns the first line of a golden G-Code file, the options it was recorded with
+def golden_header(options):
+    settings = ", ".join(f"{name}={value!r}" for name, value in sorted(options.items()) if name != 'batched')
+    return f"( GOLDEN: {settings or 'default options'} )"
+
+# Writes the golden G-Code of a CLSF file with the serial engine, this runs in a worker process
+# Returns the golden G-Code file
+def record_file(CLSF_path, options):
+    translator = translate_with('serial', CLSF_path, options)
+    
+    with open(golden_path(CLSF_path, options), "w") as golden_file:
+        golden_file.write(golden_header(options) + "\n")
+        
+        for block in program_blocks(translator):
+            golden_file.write(block + "\n")
             
-            rotated_coord = np.matmul(rotation_matrix_y, target_coord_temp)
-            rotated_coord = rotated_coord.T
+    return golden_path(CLSF_path, options)
+
+# Compares the engine against the golden G-Code of one CLSF file, this runs in a worker process
+# Returns (CLSF_path, None if equivalent or a description of the first divergence)
+def verify_file(CLSF_path, engine, options, tolerance):
+    try:
+        with open(golden_path(CLSF_path, options)) as golden_file:
+            header = golden_file.readline().rstrip("\n")
+            reference_blocks = [block.rstrip("\n") for block in golden_file]
+    except FileNotFoundError:
+        return CLSF_path, f"no golden G-Code for {golden_header(options)}, record it with --record"
+    
+    if header != golden_header(options):
+        return CLSF_path, f"golden G-Code recorded with other options {header}"
+    
+    optimized = translate_with(engine, CLSF_path, options)
+    optimized_blocks = program_blocks(optimized)
+    
+    block = first_divergence(reference_blocks, optimized_blocks, tolerance)
+    
+    if block is None:
+        return CLSF_path, None
+    
+    reference_block = reference_blocks[block] if block < len(reference_blocks) else "(end of program)"
+    optimized_block = optimized_blocks[block] if block < len(optimized_blocks) else "(end of program)"
+    n_number = reference_block.split()[0] if reference_block.startswith('N') else "-"
+    line = optimized.source_line(block)
+    
+    if line is None:
+        source = "-"
+    else:
+        source = f"{line} ({linecache.getline(CLSF_path, line).strip()})"
+    
+    return CLSF_path, (f"block {block + 1} ({n_number}), CLSF line {source}\n"
+                       f"    golden: {reference_block}\n"
+                       f"    {engine}: {optimized_block}")
+
+# Writes a random CLSF file with 3 and 5 axis moves, arcs, rapids and feed rates
+# Parameters:
+# operations (Int) : Number of TOOL PATH operations
+# seed (Int) : Random seed, the same seed writes the same file
+def synthetic_CLSF(CLSF_path, operations, seed):
+    generator = random.Random(seed)
+    tools = [("MILL", 0.5), ("BALL_MILL", 0.25), ("MILL_MULTI_AXIS", 0.375)]
+    lines = []
+    
+    for operation in range(1, operations + 1):
+        tool_name, diameter = generator.choice(tools)
+        operation_name = f"{generator.choice(['ROUGH', 'FINISH'])}_{operation}"
+        
+        # Tools are described in one or two lines
+        if generator.random() < 0.5:
+            lines.append(f"TOOL PATH/{operation_name},TOOL,{tool_name}")
+            lines.append(f"TLDATA/MILL,{diameter:.4f},0.0000,0.0000,0.0000,3.0000")
+        else:
+            lines.append(f"TOOL PATH/{operation_name},TOOL,{tool_name},MILL,{diameter:.4f},0.0000,0.0000,0.0000")
             
-            target_coord_result[0] = rotated_coord[0][0]
-            target_coord_result[1] = rotated_coord[0][1]
-            target_coord_result[2] = rotated_coord[0][2]
+        lines.append("MSYS/0.0000,0.0000,0.0000,1.0000000,0.0000000,0.0000000,0.0000000,1.0000000,0.0000000")
+        lines.append("$$ centerline data")
+        lines.append("PAINT/PATH")
+        lines.append(f"LOAD/TOOL,{operation},ADJUST,1")
+        
+        five_axis = generator.random() < 0.5
+        x, y, z = 0.0, 0.0, 1.0
+        
+        for move in range(generator.randint(20, 200)):
+            command = generator.random()
             
-            return target_coord_result
+            if command < 0.1:
+                lines.append("RAPID")
+                
+            elif command < 0.25:
+                lines.append(f"FEDRAT/IPM,{generator.uniform(5, 50):.4f}")
+                
+            elif command < 0.32 and not five_axis:
+                x_center, y_center = x + 0.5, y
+                lines.append(f"CIRCLE/{x_center:.4f},{y_center:.4f},{z:.4f},0.0000000,0.0000000,1.0000000,"
+                             "0.5000,0.0600,0.5000,0.5000,0.0000")
+                x, y = x_center, y_center + 0.5
+                lines.append(f"GOTO/{x:.4f},{y:.4f},{z:.4f}")
+                
+            else:
+                x += generator.choice([0, generator.uniform(-1, 1)])
+                y += generator.choice([0, generator.uniform(-1, 1)])
+                z += generator.choice([0, 0, generator.uniform(-0.2, 0.2)])
+                
+                if five_axis and generator.random() < 0.8:
+                    i, j, k = generator.choice([(0, 0, 1),
+                                                (0, generator.uniform(-0.5, 0.5), 1),
+                                                (generator.uniform(-0.7, 0.7), generator.uniform(-0.7, 0.7), generator.uniform(0.2, 1))])
+                    length = math.sqrt(i**2 + j**2 + k**2)
+                    lines.append(f"GOTO/{x:.4f},{y:.4f},{z:.4f},{i/length:.7f},{j/length:.7f},{k/length:.7f}")
+                else:
+                    lines.append(f"GOTO/{x:.4f},{y:.4f},{z:.4f}")
+                    
+        lines.append("END-OF-PATH")
         
-    # def rotated_coord(self, target_coord, beta, gamma):
-    #     temp_coord = self.rotate_y_transform(target_coord, beta)
-    #     final_coord = self.rotate_z_transform(temp_coord, gamma)
+    with open(CLSF_path, "w") as CLSF_File:
+        for line in lines:
+            CLSF_File.write(line + "\n")
+
+# Parameters:
+# corpus (List of String) : CLSF files and folders of CLSF files
+# engine (String) : Engine compared against the golden G-Code (See translate_with)
+# synthetic (Int) : Number of synthetic CLSF files added to the corpus, they are written once to
+#                   synthetic_folder so their golden G-Code can be recorded and kept
+# workers (Int) : Number of files compared at the same time
+# record (Boolean) : Record the golden G-Code of the corpus instead of comparing against it
+# Returns True if every file is equivalent
+def verify(corpus, engine, options, synthetic=0, workers=None, tolerance=0.0001, record=False,
+           synthetic_folder="synthetic-CLSF"):
+    CLSF_paths = []
+    
+    for path in corpus:
+        if os.path.isdir(path):
+            CLSF_paths.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                              if os.path.isfile(os.path.join(path, name)) and not name.endswith(".golden"))
+        else:
+            CLSF_paths.append(path)
+            
+    if synthetic:
+        os.makedirs(synthetic_folder, exist_ok=True)
         
-    #     return final_coord
+        for seed in range(synthetic):
+            CLSF_path = os.path.join(synthetic_folder, f"synthetic-{seed}.cls")
+            
+            if not os.path.exists(CLSF_path):
+                synthetic_CLSF(CLSF_path, 5 + seed % 20, seed)
+                
+            CLSF_paths.append(CLSF_path)
     
-    # Commands Dictionary
-    dictionary = {}
-    dictionary['TOOL PATH'] = new_operation
-    dictionary['LOAD/TOOL'] = load_tool
-    dictionary['GOTO'] = go_to
-    dictionary['CIRCLE'] = circular
-    dictionary['END-OF-PATH'] = end_of_path
+    equivalent = True
     
-    def rotate_coord(self,targ_coord):
-        beta, gamma = self.beta, self.gamma
-        gamma = gamma - 180
-        targ_coord_temp = targ_coord[:]
-        coord_temp = self.rotate_z_transform(targ_coord_temp, gamma)
-        final_coord = self.rotate_y_transform(coord_temp, beta)
-        final_coord[0] = -final_coord[0]
-        final_coord[1] = -final_coord[1]
-        return final_coord 
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if record:
+            for golden in executor.map(record_file, CLSF_paths, itertools.repeat(options)):
+                print(f"RECORDED  {golden}")
+                
+            return True
+        
+        results = executor.map(verify_file, CLSF_paths, itertools.repeat(engine),
+                               itertools.repeat(options), itertools.repeat(tolerance))
+        
+        for CLSF_path, divergence in results:
+            if divergence is None:
+                print(f"OK        {CLSF_path}")
+            else:
+                equivalent = False
+                print(f"DIVERGED  {CLSF_path}: {divergence}")
+                
+    return equivalent
 
 # Command Line Tool --------------------------------------------------------------------------
 
@@ -756,18 +1836,39 @@ def usage():
     print("-h, --help: Display options")
     print("-i, --input: Input File")
     print("-o, --output: Output Files")
+    print("-m, --machines: Machine profiles config file, posts the input once for every machine")
+    print("-s, --subprograms: Write every operation to a M97 (local) or M98 (external) subprogram")
+    print("-b, --max-blocks: Split operations into subprograms of at most this many blocks")
+    print("-j, --jobs: Number of processes parsing the input")
+    print("-r, --reorder: Group operations by tool to avoid tool changes")
+    print("-c, --constraints: Operation ordering constraints file for --reorder (E.g. ROUGH* < FINISH*)")
+    print("-a, --batched: Translate a batch of CLSF commands at a time, the moves of a batch are rotated at once")
+    print("-v, --verify: Compare an engine (serial, parallel or batched) against the golden G-Code of the CLSF files and folders given")
+    print("--record: Record the golden G-Code of the CLSF files and folders given for --verify")
+    print("--synthetic: Number of synthetic CLSF files to add to --verify or --record")
+    print("--tolerance: Largest difference allowed between coordinate words in --verify")
     
 
 # Main function for command-line argument
 def main():
     
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hi:o:", ["help", "input=","output="])
+        opts, args = getopt.getopt(sys.argv[1:], "hi:o:m:s:b:j:rc:av:", ["help", "input=","output=","machines=",
+                                                                     "subprograms=","max-blocks=","jobs=",
+                                                                     "reorder","constraints=","batched",
+                                                                     "verify=","record","synthetic=","tolerance="])
     except getopt.GetoptError as err:
         print(err)  
         usage()
         sys.exit(2)
         
+    machines = None
+    workers = None
+    options = {}
+    engine = None
+    record = False
+    synthetic = 0
+    tolerance = 0.0001
     
     for o, a in opts:
         if o in ("-h", "--help"):
@@ -777,29 +1878,68 @@ def main():
             input = a
         elif o in ("-o", "--output"):
             output = a
+        elif o in ("-m", "--machines"):
+            machines = Machine.load_machines(a)
+        elif o in ("-s", "--subprograms"):
+            if a not in ("M97", "M98"):
+                usage()
+                sys.exit(2)
+            options['subprogram_mode'] = a
+        elif o in ("-b", "--max-blocks"):
+            options['max_subprogram_blocks'] = int(a)
+            
+            if options['max_subprogram_blocks'] < CLSF_to_GCode.arc_blocks + 2:
+                print(f"--max-blocks must be at least {CLSF_to_GCode.arc_blocks + 2}")
+                sys.exit(2)
+        elif o in ("-j", "--jobs"):
+            workers = int(a)
+        elif o in ("-r", "--reorder"):
+            options['reorder'] = True
+        elif o in ("-c", "--constraints"):
+            options['reorder'] = True
+            options['order_constraints'] = load_order_constraints(a)
+        elif o in ("-a", "--batched"):
+            options['batched'] = True
+        elif o in ("-v", "--verify"):
+            engine = a
+        elif o == "--record":
+            record = True
+        elif o == "--synthetic":
+            synthetic = int(a)
+        elif o == "--tolerance":
+            tolerance = float(a)
         else:
             assert False, "unhandled option"
             
+    if engine or record:
+        if not verify(args, engine, options, synthetic, workers, tolerance, record):
+            sys.exit(1)
+        return
+            
     if debug :
         output = 'g-code.txt'
         input = 'cls.txt'
             
-    translator = CLSF_to_GCode()
-    translator.parse_CLSF(input)
-    
-    g_code_output = open(output, "w")
+    if machines:
+        # Parse once, then post for every machine
+        clsf = CLSF_Data(input, workers)
+        
+        for machine, translator in zip(machines, post(clsf, machines, **options)):
+            write_program(translator, machine_output(machine, output))
+        
+        return
+            
+    translator = CLSF_to_GCode(**options)
+    translator.parse_CLSF(input, workers)
     
-    for line in CLSF_to_GCode.g_code:
-        g_code_output.write(line + "\n")
+    write_program(translator, output)
     
     # #test
     # clsf = 'clsf_out.txt'
     # clsf_output = open(clsf,'w')
           
-    # for line in CLSF_to_GCode.CLSF:
+    # for line in translator.CLSF:
     #     clsf_output.write(line + "\n")
-        
-    g_code_output.close()  
 
 if __name__ == "__main__":
     main()